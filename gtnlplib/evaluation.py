@@ -18,7 +18,8 @@ def dependency_graph_from_oracle(sentence, actions):
         elif act == Actions.REDUCE_R:
             dependency_graph.add(stack.reduce_right())
     
-    dependency_graph.add(DepGraphEdge((ROOT_TOK, -1), (stack.stack[-1].headword, stack.stack[-1].headword_pos)))
+    root = stack.stack_top()
+    dependency_graph.add(DepGraphEdge((ROOT_TOK, -1), (root.headword, root.headword_pos)))
     return dependency_graph
 
 
@@ -1,4 +1,5 @@
 from gtnlplib.constants import NULL_STACK_TOK
+import gtnlplib.utils as utils
 
 class SimpleFeatureExtractor:
 
@@ -21,9 +22,9 @@ class SimpleFeatureExtractor:
         
         :param parser_state the ParserState object for the current parse (giving access
             to the stack and input buffer)
-        :return A list of autograd.Variable objects, which are the embeddings of your
-            features
+        :return An autograd.Variable row vector, the embeddings of your features
+            concatenated together (see utils.concat_and_flatten)
         """
-        feats = [stackEntry[2] for stackEntry in parser_state.stack_peek_n(2)]
-        feats.append(parser_state.input_buffer_peek_n(1)[0][2])
-        return feats
+        feats = parser_state.stack_peek_embeds(2)
+        feats.append(parser_state.input_buffer_peek_n(1)[0])
+        return utils.concat_and_flatten(feats)
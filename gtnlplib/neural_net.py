@@ -1,13 +1,24 @@
+import math
+
 import utils
 import torch
 import torch.nn as nn
-import torch.autograd as ag
 import torch.nn.functional as F
 
-from gtnlplib.constants import Actions, HAVE_CUDA
+from gtnlplib.constants import Actions
+
+try:
+    from torch.jit import ScriptModule, script_method, script
+except ImportError:
+    # TorchScript only exists from PyTorch 1.0 on.  Without it the scripted
+    # components below simply run in eager mode.
+    ScriptModule = nn.Module
 
-if HAVE_CUDA:
-    import torch.cuda as cuda
+    def script_method(fn):
+        return fn
+
+    def script(fn):
+        return fn
 
 # ===-----------------------------------------------------------------------------===
 # INITIAL EMBEDDING COMPONENTS
@@ -17,8 +28,8 @@ if HAVE_CUDA:
 # 
 # This class of components has the interface
 # inputs: the input sentence as a list of strings
-# outputs: a list of autograd Variables, where the ith element of the list is the
-#          embedding for the ith word.
+# outputs: an autograd Variable of shape (len(sentence), 1, embedding_dim), where
+#          output[i] is the embedding for the ith word as a (1, embedding_dim) row.
 # 
 # The output of forward() for these components is what is used to initialize the
 # input buffer, and what will be shifted onto the stack, and used in combination
@@ -27,10 +38,13 @@ if HAVE_CUDA:
 
 class VanillaWordEmbeddingLookup(nn.Module):
     """
-    A component that simply returns a list of the word embeddings as
-    autograd Variables.
+    A component that simply returns the word embeddings of the sentence
+    as a single autograd Variable.
     """
 
+    # Registered by quantize()
+    QUANTIZED_BUFFERS = ("quantized_weight", "quantized_scale", "quantized_offset")
+
     def __init__(self, word_to_ix, embedding_dim):
         """
         Construct an embedding lookup table for use in the forward()
@@ -50,17 +64,70 @@ class VanillaWordEmbeddingLookup(nn.Module):
         # name your embedding member "word_embeddings"
         self.word_embeddings = nn.Embedding(len(self.word_to_ix), self.embedding_dim)
 
+        # Index tensors of the training sentences (see parsing.train())
+        self.index_cache = utils.SequenceIndexCache()
+
 
     def forward(self, sentence):
         """
         :param sentence A list of strings, the text of the sentence
-        :return A list of autograd.Variables, where list[i] is the
-            embedding of word i in the sentence.
-            NOTE: the Variables returned should be row vectors, that
-                is, of shape (1, embedding_dim)
+        :return An autograd.Variable of shape (len(sentence), 1, embedding_dim),
+            where output[i] is the embedding of word i in the sentence as a row
+            vector.  The whole sentence is looked up in a single embedding call
+            rather than once per word.
+        """
+        inp = self.index_cache(sentence, self.word_to_ix, self.use_cuda)
+        if self.quantized:
+            rows = self.quantized_weight.index_select(0, inp).float()
+            embeds = rows * self.quantized_scale.index_select(0, inp) + self.quantized_offset.index_select(0, inp)
+            return embeds.unsqueeze(1)
+        # Index the table directly: a single gather, without going through nn.Embedding's
+        # padding_idx / max_norm handling, which this lookup never uses
+        return self.word_embeddings.weight.index_select(0, inp).unsqueeze(1)
+
+    def quantize(self):
         """
-        inp = utils.sequence_to_variable(sentence, self.word_to_ix, self.use_cuda)
-        return [self.word_embeddings(i) for i in inp]
+        Snapshot the embedding table as 8 bit integers, with a separate scale and
+        offset for every row, and look embeddings up from that from now on.
+        The lookup is purely memory bound, so this cuts the bytes read per word by 4x.
+
+        This is meant for inference: no gradient reaches word_embeddings through the
+        quantized lookup.  Call dequantize() to train again, and quantize() again
+        afterwards to pick up the new weights.
+        The quantized table is saved in state_dict(), and loading such a state dict
+        turns the quantized lookup on.
+        """
+        weight = self.word_embeddings.weight.data
+        row_min = weight.min(1, keepdim=True)[0]
+        scale = (weight.max(1, keepdim=True)[0] - row_min) / 255.
+        scale.masked_fill_(scale == 0, 1.) # rows where every entry is the same
+
+        self.register_buffer("quantized_weight", ((weight - row_min) / scale).round().byte())
+        self.register_buffer("quantized_scale", scale)
+        self.register_buffer("quantized_offset", row_min)
+
+    def dequantize(self):
+        """
+        Go back to looking embeddings up from word_embeddings
+        """
+        for name in self.QUANTIZED_BUFFERS:
+            if name in self._buffers:
+                delattr(self, name)
+
+    @property
+    def quantized(self):
+        return "quantized_weight" in self._buffers
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # The quantized buffers only exist after quantize(), so make the set of buffers
+        # match the state dict before loading it
+        if prefix + "quantized_weight" in state_dict:
+            for name in self.QUANTIZED_BUFFERS:
+                saved = state_dict[prefix + name]
+                self.register_buffer(name, saved.clone().to(self.word_embeddings.weight.device))
+        else:
+            self.dequantize()
+        super(VanillaWordEmbeddingLookup, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class BiLSTMWordEmbeddingLookup(nn.Module):
@@ -93,12 +160,20 @@ class BiLSTMWordEmbeddingLookup(nn.Module):
         # 1. An embedding lookup table
         # 2. The LSTM
         # Note we want the output dim to be hidden_dim, but since our LSTM
-        # is bidirectional, we need to make the output of each direction hidden_dim/2
+        # is bidirectional, we need to make the output of each direction hidden_dim//2
         # name your embedding member "word_embeddings"
         self.word_embeddings = nn.Embedding(len(self.word_to_ix), self.word_embedding_dim)
-        self.lstm = nn.LSTM(input_size = self.word_embedding_dim, hidden_size = self.hidden_dim / 2,
+        self.lstm = nn.LSTM(input_size = self.word_embedding_dim, hidden_size = self.hidden_dim // 2,
             num_layers = self.num_layers, dropout = dropout, bidirectional = True)
 
+        # The initial hidden state is always zeros, so allocate it once.
+        # As buffers, these follow the module across .cuda() / .cpu()
+        self.register_buffer("h0", torch.zeros(self.num_layers * 2, 1, self.hidden_dim // 2))
+        self.register_buffer("c0", torch.zeros(self.num_layers * 2, 1, self.hidden_dim // 2))
+
+        # Index tensors of the training sentences (see parsing.train())
+        self.index_cache = utils.SequenceIndexCache()
+
         self.hidden = self.init_hidden()
 
     def forward(self, sentence):
@@ -113,30 +188,59 @@ class BiLSTMWordEmbeddingLookup(nn.Module):
         2. Now that you have your tensor of embeddings of shape (len(sentence), 1, word_embedding_dim),
            You can pass it through your LSTM.
            Refer to the Pytorch documentation to see what the outputs are
-        3. Convert the outputs into the correct return type, which is a list of
-           embeddings of shape (1, embedding_dim)
+        3. Return the LSTM outputs as they are, a tensor of shape
+           (len(sentence), 1, hidden_dim); output[i] is the (1, hidden_dim)
+           embedding of word i
+        This is embed_batch() on a batch of just this sentence.
         :param sentence A list of strings, the words of the sentence
         """
+        return self.embed_batch([sentence])[0]
+
+    def embed_batch(self, sentences):
+        """
+        Run the BiLSTM over several sentences in a single call.  The LSTM is dominated
+        by its matrix multiplies, which a batch of one sentence leaves mostly idle.
+        Sentences are padded to the longest one and packed, so the padding never
+        leaks into the states of the real words in either direction.
+
+        :param sentences A list of sentences, each a list of strings
+        :return A list of Variables, where list[i] is the embedding of sentences[i]
+            as forward() gives it, of shape (len(sentences[i]), 1, hidden_dim)
+        """
         assert self.word_to_ix is not None, "ERROR: Make sure to set word_to_ix on \
                 the embedding lookup components"
-        inp = utils.sequence_to_variable(sentence, self.word_to_ix, self.use_cuda)
-        input = self.word_embeddings(inp).resize(len(sentence), 1, self.word_embedding_dim)
-
-        output, new_hidden = self.lstm(input, self.hidden)
+        # pack_padded_sequence wants the batch sorted longest sentence first
+        order = sorted(range(len(sentences)), key=lambda i: len(sentences[i]), reverse=True)
+        lengths = [ len(sentences[i]) for i in order ]
+
+        inp = nn.utils.rnn.pad_sequence([ self.index_cache(sentences[i], self.word_to_ix, self.use_cuda)
+                                          for i in order ])
+        input = self.word_embeddings(inp) # (max_len, batch_size, word_embedding_dim)
+        hidden = self.hidden if len(sentences) == 1 else self.init_hidden(len(sentences))
+
+        if lengths[0] == lengths[-1]:
+            # Nothing was padded, so there is nothing to pack
+            output, new_hidden = self.lstm(input, hidden)
+        else:
+            output, new_hidden = self.lstm(nn.utils.rnn.pack_padded_sequence(input, lengths), hidden)
+            output, _ = nn.utils.rnn.pad_packed_sequence(output)
         self.hidden = new_hidden
-        return [i for i in output]
 
-    def init_hidden(self):
+        outputs = [None] * len(sentences)
+        for batch_idx, sent_idx in enumerate(order):
+            outputs[sent_idx] = output[:lengths[batch_idx], batch_idx:batch_idx + 1]
+        return outputs
+
+    def init_hidden(self, batch_size=1):
         """
         PyTorch wants you to supply the last hidden state at each timestep
         to the LSTM.  You shouldn't need to call this function explicitly
+        :param batch_size How many sentences the LSTM is run over at once
         """
-        if self.use_cuda:
-            return (ag.Variable(cuda.FloatTensor(self.num_layers * 2, 1, self.hidden_dim / 2).zero_()),
-                    ag.Variable(cuda.FloatTensor(self.num_layers * 2, 1, self.hidden_dim / 2).zero_()))
-        else:
-            return (ag.Variable(torch.zeros(self.num_layers * 2, 1, self.hidden_dim / 2)),
-                    ag.Variable(torch.zeros(self.num_layers * 2, 1, self.hidden_dim / 2)))
+        if batch_size == 1:
+            return (self.h0, self.c0)
+        size = (self.num_layers * 2, batch_size, self.hidden_dim // 2)
+        return (self.h0.expand(*size).contiguous(), self.c0.expand(*size).contiguous())
 
     def clear_hidden_state(self):
         self.hidden = self.init_hidden()
@@ -150,7 +254,7 @@ class BiLSTMWordEmbeddingLookup(nn.Module):
 # outputs: A new embedding to place back on the stack, representing the combination
 #       of head and modifier
 
-class MLPCombinerNetwork(nn.Module):
+class MLPCombinerNetwork(ScriptModule):
     """
     This network piece takes the top two elements of the stack's embeddings
     and combines them to create a new embedding after a reduction.
@@ -172,6 +276,8 @@ class MLPCombinerNetwork(nn.Module):
     The network architecture is:
     Inputs: 2 word embeddings (the head and the modifier embeddings)
     Output: Run through an affine map + tanh + affine
+
+    forward() is compiled with TorchScript, since it runs on every reduction.
     """
 
     def __init__(self, embedding_dim):
@@ -190,13 +296,71 @@ class MLPCombinerNetwork(nn.Module):
         self.first_layer = nn.Linear(2 * embedding_dim, embedding_dim)
         self.second_layer = nn.Linear(embedding_dim, embedding_dim)
 
+    @script_method
     def forward(self, head_embed, modifier_embed):
+        # type: (Tensor, Tensor) -> Tensor
         """
-        :param head_embed The embedding of the head in the reduction
-        :param modifier_embed The embedding of the modifier in the reduction
+        :param head_embed The embedding of the head in the reduction, as a row vector
+        :param modifier_embed The embedding of the modifier in the reduction, as a row vector
         :return The embedding of the combination as a row vector
         """
-        return self.second_layer(F.tanh(self.first_layer(utils.concat_and_flatten([head_embed, modifier_embed]))))
+        return self.second_layer(torch.tanh(self.first_layer(torch.cat([head_embed, modifier_embed], 1))))
+
+
+class LSTMCell(ScriptModule):
+    """
+    One timestep of a single LSTM layer, compiled with TorchScript.
+
+    The combiner runs exactly one timestep per reduction, so going through nn.LSTM
+    pays its full dispatch overhead for a handful of tiny pointwise ops.  Scripting
+    the cell lets the fuser collapse the gate nonlinearities into a single kernel.
+    """
+
+    def __init__(self, input_dim, hidden_dim):
+        """
+        :param input_dim Dimensionality of the input at each timestep
+        :param hidden_dim Dimensionality of the hidden and cell states
+        """
+        super(LSTMCell, self).__init__()
+        self.input_dim = input_dim
+        self.hidden_dim = hidden_dim
+
+        # Gates are stacked in the same (input, forget, cell, output) order as nn.LSTM
+        self.weight_ih = nn.Parameter(torch.Tensor(4 * hidden_dim, input_dim))
+        self.weight_hh = nn.Parameter(torch.Tensor(4 * hidden_dim, hidden_dim))
+        self.bias_ih = nn.Parameter(torch.Tensor(4 * hidden_dim))
+        self.bias_hh = nn.Parameter(torch.Tensor(4 * hidden_dim))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        """
+        Same initialization nn.LSTM uses: uniform on (-1/sqrt(hidden_dim), 1/sqrt(hidden_dim))
+        """
+        stdv = 1.0 / math.sqrt(self.hidden_dim)
+        for weight in self.parameters():
+            weight.data.uniform_(-stdv, stdv)
+
+    @script_method
+    def forward(self, input, state):
+        # type: (Tensor, Tuple[Tensor, Tensor]) -> Tuple[Tensor, Tensor]
+        """
+        :param input The input at this timestep, of shape (1, input_dim)
+        :param state Tuple (h, c) of the previous hidden and cell states, each (1, hidden_dim)
+        :return Tuple (h, c) of the new hidden and cell states
+        """
+        hx, cx = state
+        gates = torch.mm(input, self.weight_ih.t()) + self.bias_ih + \
+                torch.mm(hx, self.weight_hh.t()) + self.bias_hh
+        ingate, forgetgate, cellgate, outgate = gates.chunk(4, 1)
+
+        ingate = torch.sigmoid(ingate)
+        forgetgate = torch.sigmoid(forgetgate)
+        cellgate = torch.tanh(cellgate)
+        outgate = torch.sigmoid(outgate)
+
+        cy = forgetgate * cx + ingate * cellgate
+        hy = outgate * torch.tanh(cy)
+        return hy, cy
 
 
 class LSTMCombinerNetwork(nn.Module):
@@ -212,58 +376,57 @@ class LSTMCombinerNetwork(nn.Module):
 
     def __init__(self, embedding_dim, num_layers, dropout):
         """
-        Construct your LSTM component for use in forward().
-        Think about what size the input and output of your LSTM
-        should be
+        Construct one LSTMCell per layer for use in forward().
+        The first layer reads the concatenated head and modifier embeddings,
+        every later layer reads the hidden state of the layer below it.
 
         :param embedding_dim Dimensionality of stack embeddings
         :param num_layers How many LSTM layers to use
-        :param dropout The amount of dropout to use in LSTM
+        :param dropout The amount of dropout to use between LSTM layers
         """
         super(LSTMCombinerNetwork, self).__init__()
         self.embedding_dim = embedding_dim
         self.num_layers = num_layers
-        self.use_cuda = False
+        self.dropout = dropout
 
-        self.lstm = nn.LSTM(input_size = self.embedding_dim * 2, hidden_size = embedding_dim, num_layers = num_layers,
-            dropout = dropout)
+        self.cells = nn.ModuleList([ LSTMCell(self.embedding_dim * 2 if layer == 0 else self.embedding_dim,
+                                              self.embedding_dim) for layer in range(self.num_layers) ])
+
+        # The initial state of every layer is zeros, so allocate it once and share it
+        self.register_buffer("h0", torch.zeros(1, self.embedding_dim))
+        self.register_buffer("c0", torch.zeros(1, self.embedding_dim))
 
         self.hidden = self.init_hidden()
 
 
     def init_hidden(self):
         """
-        PyTorch wants you to supply the last hidden state at each timestep
-        to the LSTM.  You shouldn't need to call this function explicitly
+        The hidden state is a list with one (h, c) tuple per layer, each
+        of shape (1, embedding_dim).  You shouldn't need to call this function explicitly
         """
-        if self.use_cuda:
-            return (ag.Variable(cuda.FloatTensor(self.num_layers, 1, self.embedding_dim).zero_()),
-                    ag.Variable(cuda.FloatTensor(self.num_layers, 1, self.embedding_dim).zero_()))
-        else:
-            return (ag.Variable(torch.FloatTensor(self.num_layers, 1, self.embedding_dim).zero_()),
-                    ag.Variable(torch.FloatTensor(self.num_layers, 1, self.embedding_dim).zero_()))
+        return [ (self.h0, self.c0) ] * self.num_layers
 
 
     def forward(self, head_embed, modifier_embed):
         """
-        Do the next LSTM step, and return the hidden state as the new
-        embedding for the reduction
-
-        Here, note that PyTorch's LSTM wants the input to be a tensor with axis semantics
-        (seq_len, batch_size, input_dimensionality), but we are not minibatching (so batch_size=1)
-        and seq_len=1 since we are only doing 1 timestep
-
-        NOTE: Make sure the tensor you hand to your LSTM is the size it wants:
-            (seq_len, batch_size, embedding_dim*2), which in this case, is (1, 1, embedding_dim*2)
-        NOTE: If you add more layers to the LSTM (more than 1), your code may break.
-            To fix it, look at the value of self.hidden whenever you have more layers.
+        Do the next LSTM step, and return the hidden state of the top layer
+        as the new embedding for the reduction
 
         :param head_embed Embedding of the head word
         :param modifier_embed Embedding of the modifier
+        :return The new embedding, of shape (1, embedding_dim)
         """
-        output, self.hidden = self.lstm(utils.concat_and_flatten([head_embed, modifier_embed]).resize(
-            self.num_layers, 1, self.embedding_dim * 2), self.hidden)
-        return self.hidden[0].resize(self.num_layers, self.embedding_dim)
+        layer_input = utils.concat_and_flatten([head_embed, modifier_embed])
+        new_hidden = []
+        for layer, (cell, state) in enumerate(zip(self.cells, self.hidden)):
+            if layer > 0:
+                # nn.LSTM semantics: dropout on the outputs of every layer but the last
+                layer_input = F.dropout(layer_input, self.dropout, self.training)
+            hx, cx = cell(layer_input, state)
+            new_hidden.append((hx, cx))
+            layer_input = hx
+        self.hidden = new_hidden
+        return layer_input
 
     def clear_hidden_state(self):
         self.hidden = self.init_hidden()
@@ -272,7 +435,20 @@ class LSTMCombinerNetwork(nn.Module):
 # ===-----------------------------------------------------------------------------===
 # ACTION CHOOSING COMPONENTS
 # ===-----------------------------------------------------------------------------===
-class ActionChooserNetwork(nn.Module):
+@script
+def small_log_softmax(x):
+    # type: (Tensor) -> Tensor
+    """
+    Numerically stable log softmax over dim 1, for rows with only a few entries
+    (like the 3 action scores).  The generic log_softmax kernel is built for large
+    vocabularies; this is just a handful of pointwise ops the fuser can merge.
+    """
+    m, _ = x.max(1, keepdim=True)
+    y = x - m
+    return y - y.exp().sum(1, keepdim=True).log()
+
+
+class ActionChooserNetwork(ScriptModule):
     """
     This network piece takes a bunch of features from the current
     state of the parser and runs them through an MLP,
@@ -280,6 +456,9 @@ class ActionChooserNetwork(nn.Module):
 
     The network should be
     inputs -> affine layer -> relu -> affine layer -> log softmax
+
+    It runs once per transition, so forward() is compiled with TorchScript
+    to keep the Python overhead of these tiny layers out of the parse loop.
     """
 
     def __init__(self, input_dim):
@@ -297,11 +476,46 @@ class ActionChooserNetwork(nn.Module):
         self.second_layer = nn.Linear(input_dim, 3)
 
 
-    def forward(self, inputs):
+    @script_method
+    def forward(self, inputs, mask=None):
+        # type: (Tensor, Optional[Tensor]) -> Tensor
         """
-        :param inputs A list of autograd.Variables, which are all of the features we will use
+        :param inputs An autograd.Variable of shape (1, input_dim), all of the features we
+            will use concatenated together (as built by the feature extractor)
+        :param mask Optional (1, 3) row added to the action scores before the softmax,
+            with a large negative value for every action that is not allowed
         :return a Variable which is the log probabilities of the actions, of shape (1, 3)
             (it is a row vector, with an entry for each action)
         """
-
-        return F.log_softmax(self.second_layer(F.relu(self.first_layer(utils.concat_and_flatten(inputs)))))
\ No newline at end of file
+        scores = self.action_scores(inputs)
+        if mask is not None:
+            scores = scores + mask
+        return small_log_softmax(scores)
+
+    @script_method
+    def predict(self, inputs, mask=None):
+        # type: (Tensor, Optional[Tensor]) -> int
+        """
+        Greedy decoding only needs the best action, and the log softmax
+        doesn't change which one that is, so skip it
+        :param inputs Same as for forward()
+        :param mask Same as for forward()
+        :return The index of the highest scoring action, as an int
+        """
+        scores = self.action_scores(inputs)
+        if mask is not None:
+            scores = scores + mask
+        return int(scores.argmax())
+
+    @script_method
+    def action_scores(self, inputs):
+        # type: (Tensor) -> Tensor
+        """
+        The two layers of the network, as one addmm each, with the relu done in place
+        on the hidden layer (addmm does not need its output for backward)
+        :param inputs Same as for forward()
+        :return The unnormalized action scores, of shape (1, 3)
+        """
+        hidden = torch.addmm(self.first_layer.bias, inputs, self.first_layer.weight.t())
+        hidden.relu_()
+        return torch.addmm(self.second_layer.bias, hidden, self.second_layer.weight.t())
\ No newline at end of file
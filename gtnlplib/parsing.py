@@ -17,7 +17,8 @@ if HAVE_CUDA:
 # check python docs
 DepGraphEdge = namedtuple("DepGraphEdge", ["head", "modifier"])
 
-# These are what initialize the input buffer, and are used on the stack.
+# An item on the stack.  The stack and input buffer store these same fields, but
+# as parallel containers rather than as tuples (see ParserState).
 # headword: The head word, stored as a string
 # headword_pos: The position of the headword in the sentence as an int
 # embedding: The embedding of the phrase as an autograd.Variable
@@ -34,25 +35,35 @@ class ParserState:
     def __init__(self, sentence, sentence_embs, combiner, null_stack_tok_embed=None):
         """
         :param sentence A list of strings, the words in the sentence
-        :param sentence_embs A list of ag.Variable objects, where the ith element is the embedding
-            of the ith word in the sentence
+        :param sentence_embs An ag.Variable of shape (len(sentence), 1, embedding_dim) (or any
+            sequence), where the ith element is the embedding of the ith word in the sentence
         :param combiner A network component that gives an output embedding given two input embeddings
             when doing a reduction
         :param null_stack_tok_embed ag.Variable The embedding of NULL_STACK_TOK
         """
         self.combiner = combiner
 
-        # Input buffer is a list, along with an index into the list.
+        # Input buffer is the words and their embeddings as handed in, along with an index into them.
         # curr_input_buff_idx points to the *next element to pop off the input buffer*
+        # (the position of a word in the sentence is its index in the buffer).
+        # The embeddings are left as one tensor: rows are only taken out of it as they are needed
         self.curr_input_buff_idx = 0
-        self.input_buffer = [ StackEntry(we[0], pos, we[1]) for pos, we in enumerate(zip(sentence, sentence_embs)) ]
-
-        self.stack = []
+        self.input_buffer_words = sentence
+        self.input_buffer_embeds = sentence_embs
+
+        # The stack is kept as three parallel lists rather than a list of StackEntry tuples,
+        # since most steps only need the embeddings off the top of it (see stack_peek_embeds()).
+        # (The embeddings stay separate Variables rather than rows of one preallocated tensor:
+        # writing into such a tensor in place would clobber activations saved for backward)
+        self.stack_headwords = []
+        self.stack_headword_pos = []
+        self.stack_embeds = []
         self.null_stack_tok_embed = null_stack_tok_embed
 
     def shift(self):
-        next_item = self.input_buffer[self.curr_input_buff_idx]
-        self.stack.append(next_item)
+        self.stack_headwords.append(self.input_buffer_words[self.curr_input_buff_idx])
+        self.stack_headword_pos.append(self.curr_input_buff_idx)
+        self.stack_embeds.append(self.input_buffer_embeds[self.curr_input_buff_idx])
         self.curr_input_buff_idx += 1
 
     def reduce_left(self):
@@ -70,34 +81,64 @@ class ParserState:
         (i.e, each SHIFT increments this index by 1).
         <END-OF-INPUT> should not be shifted onto the stack ever.
         """
-        #print self.input_buffer_peek_n(1)
-        return True if self.input_buffer_peek_n(1)[0].headword == END_OF_INPUT_TOK and self.stack_len() == 1 else False
+        return True if self.input_buffer_words[self.curr_input_buff_idx] == END_OF_INPUT_TOK and self.stack_len() == 1 else False
+
+    def action_mask_index(self):
+        """
+        Which actions are currently illegal, as an index into TransitionParser.action_masks.
+        Bit 1 is set when the stack is too short to reduce, bit 0 when the only thing
+        left to shift is END_OF_INPUT_TOK
+        """
+        return 2 * (self.stack_len() < 2) + (self.input_buffer_len() < 2)
 
     def stack_len(self):
-        return len(self.stack)
+        return len(self.stack_headwords)
 
     def input_buffer_len(self):
-        return len(self.input_buffer) - self.curr_input_buff_idx
+        return len(self.input_buffer_words) - self.curr_input_buff_idx
 
     def stack_peek_n(self, n):
         """
         Look at the top n items on the stack.
         If you ask for more than are on the stack, copies of the null_stack_tok_embed
+        are returned.  This builds a StackEntry per item; if you only need the
+        embeddings, stack_peek_embeds() is cheaper
+        :param n How many items to look at
+        :return A list of n StackEntry objects, the top of the stack last
+        """
+        top = [ StackEntry(*entry) for entry in zip(self.stack_headwords[-n:],
+                                                    self.stack_headword_pos[-n:],
+                                                    self.stack_embeds[-n:]) ]
+        if len(top) < n:
+            return [ StackEntry(NULL_STACK_TOK, -1, self.null_stack_tok_embed) ] * (n - len(top)) + top
+        return top
+
+    def stack_top(self):
+        """
+        :return StackEntry The item on top of the stack
+        """
+        return StackEntry(self.stack_headwords[-1], self.stack_headword_pos[-1], self.stack_embeds[-1])
+
+    def stack_peek_embeds(self, n):
+        """
+        Look at the embeddings of the top n items on the stack.
+        If you ask for more than are on the stack, copies of the null_stack_tok_embed
         are returned
         :param n How many items to look at
+        :return A list of the n embeddings, the top of the stack last
         """
-        if len(self.stack) - n < 0:
-            return [ StackEntry(NULL_STACK_TOK, -1, self.null_stack_tok_embed) ] * (n - len(self.stack)) \
-                   + self.stack[:]
-        return self.stack[-n:]
+        if len(self.stack_embeds) - n < 0:
+            return [ self.null_stack_tok_embed ] * (n - len(self.stack_embeds)) + self.stack_embeds[:]
+        return self.stack_embeds[-n:]
 
     def input_buffer_peek_n(self, n):
         """
-        Look at the next n words in the input buffer
+        Look at the embeddings of the next n words in the input buffer
         :param n How many words ahead to look
+        :return A slice of the sentence embeddings, of shape (n, 1, embedding_dim)
         """
-        assert self.curr_input_buff_idx + n - 1 <= len(self.input_buffer)
-        return self.input_buffer[self.curr_input_buff_idx:self.curr_input_buff_idx+n]
+        assert self.curr_input_buff_idx + n - 1 <= len(self.input_buffer_words)
+        return self.input_buffer_embeds[self.curr_input_buff_idx:self.curr_input_buff_idx+n]
 
     def _reduce(self, action):
         """
@@ -124,23 +165,27 @@ class ParserState:
         :param action Whether we reduce left or reduce right
         :return DepGraphEdge The edge that was formed in the dependency graph.
         """
-        assert len(self.stack) >= 2, "ERROR: Cannot reduce with stack length less than 2"
+        assert self.stack_len() >= 2, "ERROR: Cannot reduce with stack length less than 2"
         
-        elemR = self.stack.pop()
-        elemL = self.stack.pop()
+        wordR, posR, embedR = self.stack_headwords.pop(), self.stack_headword_pos.pop(), self.stack_embeds.pop()
+        wordL, posL, embedL = self.stack_headwords.pop(), self.stack_headword_pos.pop(), self.stack_embeds.pop()
         if action == Actions.REDUCE_L:
-            self.stack.append(StackEntry(elemR.headword, elemR.headword_pos, self.combiner(elemR.embedding, elemL.embedding)))
-            return DepGraphEdge((elemR.headword, elemR.headword_pos), (elemL.headword, elemL.headword_pos))
+            head_word, head_pos, head_embed = wordR, posR, embedR
+            modifier_word, modifier_pos, modifier_embed = wordL, posL, embedL
         else:
-            self.stack.append(StackEntry(elemL.headword, elemL.headword_pos, self.combiner(elemL.embedding, elemR.embedding)))
-            return DepGraphEdge((elemL.headword, elemL.headword_pos), (elemR.headword, elemR.headword_pos))
+            head_word, head_pos, head_embed = wordL, posL, embedL
+            modifier_word, modifier_pos, modifier_embed = wordR, posR, embedR
+        self.stack_headwords.append(head_word)
+        self.stack_headword_pos.append(head_pos)
+        self.stack_embeds.append(self.combiner(head_embed, modifier_embed))
+        return DepGraphEdge((head_word, head_pos), (modifier_word, modifier_pos))
 
     def __str__(self):
         """
         Print the state for debugging
         """
-        return "Stack: {}\nInput Buffer: {}\n".format([ entry.headword for entry in self.stack ], 
-                [ entry.headword for entry in self.input_buffer[self.curr_input_buff_idx:] ])
+        return "Stack: {}\nInput Buffer: {}\n".format(self.stack_headwords, 
+                self.input_buffer_words[self.curr_input_buff_idx:])
 
 
 
@@ -165,8 +210,16 @@ class TransitionParser(nn.Module):
         # This embedding is what is returned to indicate that part of the stack is empty
         self.null_stack_tok_embed = nn.Parameter(torch.randn(1, word_embedding_component.output_dim))
 
+        # Added to the action scores to rule out illegal actions, so that the action chooser
+        # can only ever pick a valid one.  Indexed by ParserState.action_mask_index()
+        action_masks = torch.zeros(4, 1, Actions.NUM_ACTIONS)
+        action_masks[1::2, :, Actions.SHIFT] = -1e9
+        action_masks[2:, :, Actions.REDUCE_L] = -1e9
+        action_masks[2:, :, Actions.REDUCE_R] = -1e9
+        self.register_buffer("action_masks", action_masks)
 
-    def forward(self, sentence, actions=None):
+
+    def forward(self, sentence, actions=None, sentence_embs=None, return_log_probs=True):
         """
         Does the core parsing logic.
         If you are supplied actions, you should do those.
@@ -188,13 +241,21 @@ class TransitionParser(nn.Module):
         E.g Actions.SHIFT is 0, Actions.REDUCE_L is 1, so that the 0th element of
         the output of your action chooser is the log probability of shift, the 1st is the log probability
         of REDUCE_L, etc.
+
+        If sentence_embs is given (see embed_sentences()), it is used to initialize the input buffer
+        instead of running the word embedding component on the sentence.
+
+        If return_log_probs is False and no actions are supplied, the log probabilities are never
+        computed: each action is picked with the action chooser's predict(), and the returned
+        list of log probabilities is empty.
         """
         self.refresh() # clear up hidden states from last run, if need be
 
         padded_sent = sentence + [END_OF_INPUT_TOK]
 
         # Initialize the parser state
-        sentence_embs = self.word_embedding_component(padded_sent)
+        if sentence_embs is None:
+            sentence_embs = self.word_embedding_component(padded_sent)
 
         parser_state = ParserState(padded_sent, sentence_embs, self.combiner, null_stack_tok_embed=self.null_stack_tok_embed)
         outputs = [] # Holds the output of each action decision
@@ -213,43 +274,47 @@ class TransitionParser(nn.Module):
 
         # Loop until parsing state is in terminating state
         while not parser_state.done_parsing():
-            outputs.append(self.action_chooser(self.feature_extractor.get_features(parser_state)))
+            features = self.feature_extractor.get_features(parser_state)
+            mask = self.action_masks[parser_state.action_mask_index()]
+            if have_gold_actions or return_log_probs:
+                outputs.append(self.action_chooser(features, mask))
+
+            # The mask means whatever the action chooser picks is a valid action
             if have_gold_actions:
-                actions_done.append(action_queue.pop())
-                if actions_done[-1] == Actions.SHIFT:
-                    parser_state.shift()
-                elif actions_done[-1] == Actions.REDUCE_L:
-                    dep_graph.add(parser_state.reduce_left())
-                elif actions_done[-1] == Actions.REDUCE_R:
-                    dep_graph.add(parser_state.reduce_right())
+                action = action_queue.pop()
+            elif return_log_probs:
+                action = utils.argmax(outputs[-1])
             else:
-                max = utils.argmax(outputs[-1])
-                if max == Actions.SHIFT:
-                    if parser_state.input_buffer_len() >= 2:
-                        parser_state.shift()
-                        actions_done.append(Actions.SHIFT)
-                    else:
-                        dep_graph.add(parser_state.reduce_right())
-                        actions_done.append(Actions.REDUCE_R)
-                elif max == Actions.REDUCE_L:
-                    if parser_state.stack_len() >= 2:
-                        dep_graph.add(parser_state.reduce_left())
-                        actions_done.append(Actions.REDUCE_L)
-                    else:
-                        parser_state.shift()
-                        actions_done.append(Actions.SHIFT)
-                elif max == Actions.REDUCE_R:
-                    if parser_state.stack_len() >= 2:
-                        dep_graph.add(parser_state.reduce_right())
-                        actions_done.append(Actions.REDUCE_R)
-                    else:
-                        parser_state.shift()
-                        actions_done.append(Actions.SHIFT)
-
-        dep_graph.add(DepGraphEdge((ROOT_TOK, -1), (parser_state.stack[-1].headword, parser_state.stack[-1].headword_pos)))
+                action = self.action_chooser.predict(features, mask)
+
+            actions_done.append(action)
+            if action == Actions.SHIFT:
+                parser_state.shift()
+            elif action == Actions.REDUCE_L:
+                dep_graph.add(parser_state.reduce_left())
+            elif action == Actions.REDUCE_R:
+                dep_graph.add(parser_state.reduce_right())
+
+        root = parser_state.stack_top()
+        dep_graph.add(DepGraphEdge((ROOT_TOK, -1), (root.headword, root.headword_pos)))
         return outputs, dep_graph, actions_done
 
 
+    def embed_sentences(self, sentences):
+        """
+        Get the input buffer embeddings of several sentences at once, to hand to forward().
+        Word embedding components that can batch (BiLSTMWordEmbeddingLookup) embed all of
+        them in a single call.
+        :param sentences A list of sentences, each a list of strings (without END_OF_INPUT_TOK)
+        :return A list, where list[i] is the sentence_embs argument for forward(sentences[i])
+        """
+        padded_sents = [ sentence + [END_OF_INPUT_TOK] for sentence in sentences ]
+        if isinstance(self.word_embedding_component, neural_net.BiLSTMWordEmbeddingLookup):
+            self.word_embedding_component.clear_hidden_state()
+            return self.word_embedding_component.embed_batch(padded_sents)
+        return [ self.word_embedding_component(sentence) for sentence in padded_sents ]
+
+
     def refresh(self):
         if isinstance(self.combiner, neural_net.LSTMCombinerNetwork):
             self.combiner.clear_hidden_state()
@@ -258,26 +323,26 @@ class TransitionParser(nn.Module):
 
 
     def predict(self, sentence):
-        _, dep_graph, _ = self.forward(sentence)
+        with torch.no_grad():
+            _, dep_graph, _ = self.forward(sentence, return_log_probs=False)
         return dep_graph
 
 
     def predict_actions(self, sentence):
-        _, _, actions_done = self.forward(sentence)
+        with torch.no_grad():
+            _, _, actions_done = self.forward(sentence, return_log_probs=False)
         return actions_done
     
 
     def to_cuda(self):
         self.use_cuda = True
         self.word_embedding_component.use_cuda = True
-        self.combiner.use_cuda = True
         self.cuda()
 
 
     def to_cpu(self):
         self.use_cuda = False
         self.word_embedding_component.use_cuda = False
-        self.combiner.use_cuda = False
         self.cpu()
 
 
@@ -292,6 +357,11 @@ def train(data, model, optimizer, verbose=True):
     tot_loss = 0.
     instance_count = 0
 
+    # The same sentences come back every epoch, so keep their index tensors around
+    index_cache = getattr(model.word_embedding_component, "index_cache", None)
+    if index_cache is not None:
+        index_cache.enabled = True
+
     for sentence, actions in data:
 
         if len(sentence) <= 2:
@@ -324,6 +394,9 @@ def train(data, model, optimizer, verbose=True):
         loss.backward()
         optimizer.step()
 
+    if index_cache is not None:
+        index_cache.enabled = False
+
     acc = float(correct_actions) / total_actions
     loss = float(tot_loss) / instance_count
     if verbose:
@@ -331,7 +404,7 @@ def train(data, model, optimizer, verbose=True):
         print "Acc: {}  Loss: {}".format(float(correct_actions) / total_actions, tot_loss / instance_count)
 
 
-def evaluate(data, model, verbose=False):
+def evaluate(data, model, verbose=False, batch_size=32):
 
     correct_actions = 0
     total_actions = 0
@@ -339,25 +412,31 @@ def evaluate(data, model, verbose=False):
     instance_count = 0
     criterion = nn.NLLLoss()
 
-    for sentence, actions in data:
+    data = [ (sentence, actions) for sentence, actions in data if len(sentence) > 1 ]
 
-        if len(sentence) > 1:
-            outputs, _, actions_done = model(sentence, actions)
+    # Nothing is trained here, so the sentences can be embedded a batch at a time up front
+    with torch.no_grad():
+        for batch_start in xrange(0, len(data), batch_size):
+            batch = data[batch_start:batch_start + batch_size]
+            batch_embs = model.embed_sentences([ sentence for sentence, _ in batch ])
 
-            loss = ag.Variable(torch.FloatTensor([0]))
-            action_idxs = [ ag.Variable(torch.LongTensor([ a ])) for a in actions_done ]
-            for output, act in zip(outputs, action_idxs):
-                loss += criterion(output.view((-1, 3)), act)
+            for (sentence, actions), sentence_embs in zip(batch, batch_embs):
+                outputs, _, actions_done = model(sentence, actions, sentence_embs=sentence_embs)
+
+                loss = ag.Variable(torch.FloatTensor([0]))
+                action_idxs = [ ag.Variable(torch.LongTensor([ a ])) for a in actions_done ]
+                for output, act in zip(outputs, action_idxs):
+                    loss += criterion(output.view((-1, 3)), act)
 
-            tot_loss += utils.to_scalar(loss.data)
-            instance_count += 1
+                tot_loss += utils.to_scalar(loss.data)
+                instance_count += 1
 
-            for gold, output in zip(actions_done, outputs):
-                pred_act = utils.argmax(output.data)
-                if pred_act == gold:
-                    correct_actions += 1
+                for gold, output in zip(actions_done, outputs):
+                    pred_act = utils.argmax(output.data)
+                    if pred_act == gold:
+                        correct_actions += 1
 
-            total_actions += len(outputs)
+                total_actions += len(outputs)
 
     acc = float(correct_actions) / total_actions
     loss = float(tot_loss) / instance_count
@@ -1,9 +1,6 @@
 import torch
 import torch.autograd as ag
-from gtnlplib.constants import END_OF_INPUT_TOK, HAVE_CUDA
-
-if HAVE_CUDA:
-    import torch.cuda as cuda
+from gtnlplib.constants import END_OF_INPUT_TOK
 
 
 def word_to_variable_embed(word, word_embeddings, word_to_ix):
@@ -12,11 +9,55 @@ def word_to_variable_embed(word, word_embeddings, word_to_ix):
 
 def sequence_to_variable(sequence, to_ix, use_cuda=False):
     if use_cuda:
-        return ag.Variable( cuda.LongTensor([ to_ix[t] for t in sequence ]) )
+        # Stage the indices in pinned memory so the copy to the GPU doesn't block
+        return ag.Variable( torch.LongTensor([ to_ix[t] for t in sequence ]).pin_memory().cuda(non_blocking=True) )
     else:
         return ag.Variable( torch.LongTensor([ to_ix[t] for t in sequence ]) )
 
 
+class SequenceIndexCache:
+    """
+    Remembers the index tensors sequence_to_variable makes for the sequences it is given.
+    Training sees the same sentences every epoch, and this skips redoing their index
+    lookups and tensor allocations.
+
+    Nothing is kept unless enabled is set (parsing.train() turns it on while it runs),
+    and at most max_entries sequences are kept; after that, new sequences are just
+    converted.  The cache is emptied whenever it is called with a different to_ix
+    dict or use_cuda, and it is never pickled along with the model that owns it.
+    """
+
+    def __init__(self, max_entries=20000):
+        """
+        :param max_entries The most sequences to keep at once
+        """
+        self.max_entries = max_entries
+        self.enabled = False
+        self.to_ix = None
+        self.use_cuda = False
+        self.cache = {}
+
+    def __call__(self, sequence, to_ix, use_cuda=False):
+        if to_ix is not self.to_ix or use_cuda != self.use_cuda:
+            self.to_ix = to_ix
+            self.use_cuda = use_cuda
+            self.cache = {}
+        if not self.enabled:
+            return sequence_to_variable(sequence, to_ix, use_cuda)
+
+        key = tuple(sequence)
+        if key in self.cache:
+            return self.cache[key]
+        inp = sequence_to_variable(sequence, to_ix, use_cuda)
+        if len(self.cache) < self.max_entries:
+            self.cache[key] = inp
+        return inp
+
+    def __getstate__(self):
+        return { "max_entries": self.max_entries, "enabled": False,
+                 "to_ix": None, "use_cuda": False, "cache": {} }
+
+
 def to_scalar(var):
     """
     Wrap up the terse, obnoxious code to go from torch.Tensor to
@@ -72,10 +113,15 @@ class DummyActionChooser:
     def __init__(self):
         self.counter = 0
 
-    def __call__(self, inputs):
+    def __call__(self, inputs, mask=None):
         self.counter += 1
+        if mask is not None:
+            return ag.Variable(torch.Tensor([0., 0., 1.])) + mask.view(-1)
         return ag.Variable(torch.Tensor([0., 0., 1.]))
 
+    def predict(self, inputs, mask=None):
+        return argmax(self(inputs, mask).view(1, -1))
+
 
 class DummyWordEmbeddingLookup:
 